@@ -1,514 +1,704 @@
-from flask import Flask, render_template, request, redirect, url_for, session, send_file, jsonify, abort
-import sqlite3, os, io, pandas as pd
-from datetime import datetime, timedelta
-from werkzeug.security import generate_password_hash, check_password_hash
-
-app = Flask(__name__)
-app.secret_key = os.urandom(24)
-app.permanent_session_lifetime = timedelta(days=7)
-
-DB = "finance.db"
-
-# =========================
-# DB
-# =========================
-def connect():
-    con = sqlite3.connect(DB)
-    con.row_factory = sqlite3.Row
-    return con
-
-def init_db():
-    con = connect()
-    cur = con.cursor()
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users(
-        username TEXT PRIMARY KEY,
-        password TEXT
-    )
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS financials(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        company_name TEXT,
-        industry TEXT,
-        year INTEGER,
-
-        sales REAL,
-        gross_profit REAL,
-        net_income REAL,
-
-        total_assets REAL,
-        equity REAL,
-        current_assets REAL,
-        current_liabilities REAL,
-        liabilities REAL,
-
-        employees INTEGER,
-
-        gross_profit_margin REAL,
-        roe REAL,
-        current_ratio REAL,
-        debt_ratio REAL,
-        sales_per_employee REAL,
-        productivity REAL,
-
-        user_id TEXT
-    )
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS comments(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        financial_id INTEGER,
-        user_id TEXT,
-        content TEXT,
-        created_at TEXT DEFAULT CURRENT_TIMESTAMP
-    )
-    """)
-
-    con.commit()
-    con.close()
-
-# =========================
-# Helpers
-# =========================
-MONEY_FIELDS = [
-    "sales", "gross_profit", "net_income",
-    "total_assets", "equity",
-    "current_assets", "current_liabilities",
-    "liabilities"
-]
-
-def _to_float(v) -> float:
-    if v is None:
-        return 0.0
-    s = str(v).strip().replace(",", "").replace("，", "").replace(" ", "")
-    if s == "":
-        return 0.0
-    return float(s)
-
-def _to_int(v) -> int:
-    if v is None:
-        return 0
-    s = str(v).strip().replace(",", "").replace("，", "").replace(" ", "")
-    if s == "":
-        return 0
-    return int(float(s))  # "12.0" 対策
-
-def parse_financial_form_with_unit(form) -> dict:
-    """
-    入力単位(unit)を反映して、DB保存用「円」に統一したdictを返す
-    unit: 1(円) / 1000(千円) / 1000000(百万円)
-    """
-    unit = _to_float(form.get("unit", "1"))
-    if unit not in (1.0, 1000.0, 1000000.0):
-        unit = 1.0
-
-    d = {}
-    for k in MONEY_FIELDS:
-        d[k] = _to_float(form.get(k)) * unit  # ← unit反映（円換算）
-    d["employees"] = _to_int(form.get("employees"))
-    return d
-
-# =========================
-# Indicator calc
-# =========================
-def calc(d):
-    return {
-        "gross_profit_margin": d["gross_profit"]/d["sales"] if d["sales"] else 0,
-        "roe": d["net_income"]/d["equity"] if d["equity"] else 0,
-        "current_ratio": d["current_assets"]/d["current_liabilities"] if d["current_liabilities"] else 0,
-        "debt_ratio": d["liabilities"]/d["total_assets"] if d["total_assets"] else 0,
-        "sales_per_employee": d["sales"]/d["employees"] if d["employees"] else 0,
-        "productivity": d["net_income"]/d["employees"] if d["employees"] else 0,
-    }
-
-# =========================
-# Auth
-# =========================
-@app.route("/register", methods=["GET","POST"])
-def register():
-    if request.method == "POST":
-        u, p = request.form["username"], request.form["password"]
-        con = connect()
-        cur = con.cursor()
-        cur.execute("SELECT 1 FROM users WHERE username=?", (u,))
-        if cur.fetchone():
-            con.close()
-            return "既に存在します"
-        cur.execute("INSERT INTO users VALUES(?,?)", (u, generate_password_hash(p)))
-        con.commit()
-        con.close()
-        return redirect(url_for("login"))
-    return render_template("register.html")
-
-@app.route("/login", methods=["GET","POST"])
-def login():
-    if request.method == "POST":
-        u, p = request.form["username"], request.form["password"]
-        con = connect()
-        cur = con.cursor()
-        cur.execute("SELECT * FROM users WHERE username=?", (u,))
-        user = cur.fetchone()
-        con.close()
-        if user and check_password_hash(user["password"], p):
-            session["user_id"] = u
-            return redirect(url_for("index"))
-        return "ログイン失敗"
-    return render_template("login.html")
-
-@app.route("/logout")
-def logout():
-    session.clear()
-    return redirect(url_for("login"))
-
-# =========================
-# Main input
-# =========================
-@app.route("/", methods=["GET","POST"])
-def index():
-    if "user_id" not in session:
-        return redirect(url_for("login"))
-
-    current_year = datetime.now().year
-
-    if request.method == "POST":
-        f = request.form
-
-        # 1) unitを反映して円換算
-        d = parse_financial_form_with_unit(f)
-
-        # 2) 文字項目
-        company_name = f.get("company_name", "").strip()
-        industry = f.get("industry", "").strip()
-        year = _to_int(f.get("year"))
-
-        # 3) 指標計算
-        d.update(calc(d))
-
-        con = connect()
-        cur = con.cursor()
-        cur.execute(
-            """
-            INSERT INTO financials(
-                company_name, industry, year,
-                sales, gross_profit, net_income,
-                total_assets, equity, current_assets, current_liabilities, liabilities,
-                employees,
-                gross_profit_margin, roe, current_ratio, debt_ratio, sales_per_employee, productivity,
-                user_id
-            )
-            VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-            """,
-            (
-                company_name, industry, year,
-                d["sales"], d["gross_profit"], d["net_income"],
-                d["total_assets"], d["equity"], d["current_assets"], d["current_liabilities"], d["liabilities"],
-                d["employees"],
-                d["gross_profit_margin"], d["roe"], d["current_ratio"], d["debt_ratio"],
-                d["sales_per_employee"], d["productivity"],
-                session["user_id"],
-            )
-        )
-        con.commit()
-        con.close()
-        return redirect(url_for("view_data"))
-
-    return render_template("index.html", current_year=current_year)
-
-# =========================
-# Industry list (JSON)
-# =========================
-@app.route("/industry_list")
-def industry_list():
-    if "user_id" not in session:
-        return jsonify([])
-
-    con = connect()
-    cur = con.cursor()
-    cur.execute(
-        "SELECT DISTINCT industry FROM financials WHERE user_id=? AND industry IS NOT NULL AND industry != ''",
-        (session["user_id"],)
-    )
-    data = [r[0] for r in cur.fetchall()]
-    con.close()
-    return jsonify(data)
-
-# =========================
-# View
-# =========================
-@app.route("/view_data")
-def view_data():
-    if "user_id" not in session:
-        return redirect(url_for("login"))
-
-    company_name = request.args.get("company_name", "").strip()
-    industry = request.args.get("industry", "").strip()
-
-    con = connect()
-    cur = con.cursor()
-
-    # 動的WHERE条件
-    where = ["user_id = ?"]
-    params = [session["user_id"]]
-
-    if company_name:
-        where.append("company_name LIKE ?")
-        params.append(f"%{company_name}%")
-
-    if industry:
-        where.append("industry LIKE ?")
-        params.append(f"%{industry}%")
-
-    sql = f"""
-        SELECT * FROM financials
-        WHERE {' AND '.join(where)}
-        ORDER BY company_name, year
-    """
-
-    cur.execute(sql, params)
-    financials = cur.fetchall()
-
-    # コメント取得
-    cur.execute("SELECT * FROM comments WHERE user_id=?", (session["user_id"],))
-    com = cur.fetchall()
-    con.close()
-
-    comments = {}
-    for c in com:
-        comments.setdefault(c["financial_id"], []).append(c)
-
-    return render_template(
-        "view_data.html",
-        financial_data=financials,
-        comments_by_id=comments,
-        company_name=company_name,
-        industry=industry
-    )
-
-# =========================
-# Edit
-# =========================
-@app.route("/edit/<int:id>", methods=["GET","POST"])
-def edit_data(id):
-    if "user_id" not in session:
-        return redirect(url_for("login"))
-
-    con = connect()
-    cur = con.cursor()
-
-    # 本人のデータか確認
-    cur.execute("SELECT * FROM financials WHERE id=? AND user_id=?", (id, session["user_id"]))
-    data = cur.fetchone()
-    if data is None:
-        con.close()
-        abort(404)
-
-    if request.method == "POST":
-        f = request.form
-
-        d = {k: _to_float(f.get(k)) for k in MONEY_FIELDS}
-        d["employees"] = _to_int(f.get("employees"))
-
-        year = _to_int(f.get("year"))
-        company_name = f.get("company_name", "").strip()
-        industry = f.get("industry", "").strip()
-
-        d.update(calc(d))
-
-        cur.execute(
-            """
-            UPDATE financials SET
-                company_name=?, industry=?, year=?,
-                sales=?, gross_profit=?, net_income=?,
-                total_assets=?, equity=?, current_assets=?, current_liabilities=?, liabilities=?,
-                employees=?,
-                gross_profit_margin=?, roe=?, current_ratio=?, debt_ratio=?, sales_per_employee=?, productivity=?
-            WHERE id=? AND user_id=?
-            """,
-            (
-                company_name, industry, year,
-                d["sales"], d["gross_profit"], d["net_income"],
-                d["total_assets"], d["equity"], d["current_assets"], d["current_liabilities"], d["liabilities"],
-                d["employees"],
-                d["gross_profit_margin"], d["roe"], d["current_ratio"], d["debt_ratio"],
-                d["sales_per_employee"], d["productivity"],
-                id, session["user_id"],
-            )
-        )
-
-        con.commit()
-        con.close()
-        return redirect(url_for("edit_data", id=id))
-
-    cur.execute(
-        "SELECT * FROM comments WHERE financial_id=? AND user_id=? ORDER BY id DESC",
-        (id, session["user_id"])
-    )
-    comments = cur.fetchall()
-    con.close()
-
-    return render_template("edit_data.html", data=data, comments=comments)
-
-# =========================
-# Comment
-# =========================
-@app.route("/add_comment/<int:id>", methods=["POST"])
-def add_comment(id):
-    if "user_id" not in session:
-        return redirect(url_for("login"))
-
-    con = connect()
-    cur = con.cursor()
-
-    cur.execute("SELECT id FROM financials WHERE id=? AND user_id=?", (id, session["user_id"]))
-    if cur.fetchone() is None:
-        con.close()
-        abort(404)
-
-    content = request.form.get("content", "").strip()
-    if content == "":
-        con.close()
-        return redirect(url_for("edit_data", id=id))
-
-    cur.execute(
-        "INSERT INTO comments(financial_id, user_id, content) VALUES(?,?,?)",
-        (id, session["user_id"], content)
-    )
-    con.commit()
-    con.close()
-    return redirect(url_for("edit_data", id=id))
-
-@app.route("/edit_comment/<int:id>", methods=["POST"])
-def edit_comment(id):
-    if "user_id" not in session:
-        return redirect(url_for("login"))
-
-    con = connect()
-    cur = con.cursor()
-
-    cur.execute("SELECT financial_id FROM comments WHERE id=? AND user_id=?", (id, session["user_id"]))
-    row = cur.fetchone()
-    if row is None:
-        con.close()
-        abort(404)
-
-    fid = row["financial_id"]
-
-    content = request.form.get("content", "").strip()
-    if content == "":
-        con.close()
-        return redirect(url_for("edit_data", id=fid))
-
-    cur.execute("UPDATE comments SET content=? WHERE id=? AND user_id=?", (content, id, session["user_id"]))
-    con.commit()
-    con.close()
-    return redirect(url_for("edit_data", id=fid))
-
-@app.route("/delete_comment/<int:id>", methods=["POST"])
-def delete_comment(id):
-    if "user_id" not in session:
-        return redirect(url_for("login"))
-
-    con = connect()
-    cur = con.cursor()
-
-    cur.execute("SELECT financial_id FROM comments WHERE id=? AND user_id=?", (id, session["user_id"]))
-    row = cur.fetchone()
-    if row is None:
-        con.close()
-        abort(404)
-
-    fid = row["financial_id"]
-
-    cur.execute("DELETE FROM comments WHERE id=? AND user_id=?", (id, session["user_id"]))
-    con.commit()
-    con.close()
-    return redirect(url_for("edit_data", id=fid))
-
-# =========================
-# Excel
-# =========================
-@app.route("/download_excel")
-def download_excel():
-    if "user_id" not in session:
-        return redirect(url_for("login"))
-
-    con = connect()
-    cur = con.cursor()
-
-    cur.execute("""
-        SELECT f.*,
-               GROUP_CONCAT(comments.content, ' / ') AS comments
-        FROM financials AS f
-        LEFT JOIN comments
-               ON f.id = comments.financial_id
-              AND comments.user_id = ?
-        WHERE f.user_id = ?
-        GROUP BY f.id
-        ORDER BY f.company_name, f.year
-    """, (session["user_id"], session["user_id"]))
-
-    rows = cur.fetchall()
-    con.close()
-
-    df = pd.DataFrame([dict(r) for r in rows])
-    df = df.drop(columns=["id", "user_id"], errors="ignore")
-
-    out = io.BytesIO()
-    df.to_excel(out, index=False)
-    out.seek(0)
-
-    return send_file(out, download_name="financial_data.xlsx", as_attachment=True)
-
-# =========================
-# Graph
-# =========================
-@app.route("/graph_view")
-def graph_view():
-    if "user_id" not in session:
-        return redirect(url_for("login"))
-
-    con = connect()
-    cur = con.cursor()
-
-    cur.execute("""
-        SELECT company_name, year, sales, roe, productivity
-        FROM financials
-        WHERE user_id=?
-        ORDER BY company_name, year
-    """, (session["user_id"],))
-
-    rows = [dict(r) for r in cur.fetchall()]
-    con.close()
-
-    return render_template("graph.html", rows=rows)
-
-@app.route("/get_companies")
-def get_companies():
-    if "user_id" not in session:
-        return jsonify([])
-
-    q = request.args.get("query", "").strip()
-    con = connect()
-    cur = con.cursor()
-    cur.execute("""
-        SELECT DISTINCT company_name
-        FROM financials
-        WHERE user_id=? AND company_name LIKE ?
-        ORDER BY company_name
-        LIMIT 10
-    """, (session["user_id"], f"%{q}%"))
-    rows = [r[0] for r in cur.fetchall()]
-    con.close()
-    return jsonify(rows)
-
-
-# =========================
-# Run
-# =========================
-if __name__ == "__main__":
-    init_db()
-    app.run(debug=True)
+from flask import Flask, render_template, request, redirect, url_for, session, send_file, jsonify, abort
+from jinja2 import FileSystemBytecodeCache
+import sqlite3, os, io, atexit, hashlib, json, queue, tempfile, xlsxwriter
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from werkzeug.security import generate_password_hash, check_password_hash
+
+app = Flask(__name__)
+# 再起動・ワーカー間でセッションを維持するため環境変数から読む
+app.secret_key = os.environ.get("FLASK_SECRET_KEY")
+if not app.secret_key:
+    app.logger.warning("FLASK_SECRET_KEY is not set; sessions will not survive restarts")
+    app.secret_key = os.urandom(24)
+app.permanent_session_lifetime = timedelta(days=7)
+# セッションはlogin/logout以外で書き換えない（読み取りだけなら再署名が走らない）
+app.config.update(
+    SESSION_COOKIE_HTTPONLY=True,
+    SESSION_COOKIE_SAMESITE="Lax",
+    SEND_FILE_MAX_AGE_DEFAULT=timedelta(days=30),  # /static はほぼ変わらないので長めに
+)
+# テンプレートのコンパイル結果をプロセス再起動をまたいで使い回す
+_jinja_cache_dir = os.path.join(tempfile.gettempdir(), "finance_app_jinja_cache")
+os.makedirs(_jinja_cache_dir, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(_jinja_cache_dir)
+
+DB = "finance.db"
+
+# ハッシュ方式は固定（Werkzeugのデフォルト変更でログインが重くならないように）
+HASH_METHOD = "scrypt:32768:8:1"
+# 存在しないユーザーでも同じコストで検証し、応答時間から存在が漏れないようにする
+_DUMMY_HASH = generate_password_hash("dummy", method=HASH_METHOD)
+
+# =========================
+# DB
+# =========================
+# 接続は毎回開かず、ワーカー内で使い回す（接続＋PRAGMAのコストを初回のみに）
+_pool = queue.LifoQueue()
+
+def _new_conn():
+    con = sqlite3.connect(DB, check_same_thread=False)
+    con.row_factory = sqlite3.Row
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA cache_size=-20000")
+    con.execute("PRAGMA temp_store=MEMORY")
+    return con
+
+@contextmanager
+def get_conn():
+    try:
+        con = _pool.get_nowait()
+    except queue.Empty:
+        con = _new_conn()
+    try:
+        yield con
+    finally:
+        # 途中で例外が起きてもトランザクションを持ち帰らない
+        if con.in_transaction:
+            con.rollback()
+        _pool.put(con)
+
+@atexit.register
+def _close_pool():
+    while True:
+        try:
+            _pool.get_nowait().close()
+        except queue.Empty:
+            break
+
+def init_db():
+    with get_conn() as con, con:
+        cur = con.cursor()
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS users(
+            username TEXT PRIMARY KEY,
+            password TEXT
+        )
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS financials(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            company_name TEXT,
+            industry TEXT,
+            year INTEGER,
+
+            sales REAL,
+            gross_profit REAL,
+            net_income REAL,
+
+            total_assets REAL,
+            equity REAL,
+            current_assets REAL,
+            current_liabilities REAL,
+            liabilities REAL,
+
+            employees INTEGER,
+
+            gross_profit_margin REAL,
+            roe REAL,
+            current_ratio REAL,
+            debt_ratio REAL,
+            sales_per_employee REAL,
+            productivity REAL,
+
+            user_id TEXT
+        )
+        """)
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS comments(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            financial_id INTEGER,
+            user_id TEXT,
+            content TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+
+        # user_id絞り込みが全クエリ共通なのでインデックスを張る
+        # (user_id, company_name, year) は ORDER BY company_name, year も兼ねる
+        cur.execute("CREATE INDEX IF NOT EXISTS ix_fin_user ON financials(user_id, company_name, year)")
+        cur.execute("CREATE INDEX IF NOT EXISTS ix_com_user ON comments(user_id, financial_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS ix_com_fid ON comments(financial_id)")
+
+        # 旧: オートコンプリートをFTS5で引いていた頃の残骸を掃除
+        # （ログイン時プリロード方式に置き換え済み）
+        cur.execute("DROP TRIGGER IF EXISTS trg_fin_fts_ins")
+        cur.execute("DROP TRIGGER IF EXISTS trg_fin_fts_upd")
+        cur.execute("DROP TRIGGER IF EXISTS trg_fin_fts_del")
+        cur.execute("DROP TABLE IF EXISTS company_fts")
+
+        # ユーザーごとの最終更新時刻（Excelの条件付きGET用）
+        # financials / comments への書き込みでトリガーが更新する
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS user_meta(
+            user_id TEXT PRIMARY KEY,
+            updated_at TEXT NOT NULL
+        )
+        """)
+        for tbl in ("financials", "comments"):
+            for op, ref in (("insert", "new"), ("update", "new"), ("delete", "old")):
+                cur.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{tbl}_touch_{op} AFTER {op.upper()} ON {tbl} BEGIN
+                    INSERT INTO user_meta(user_id, updated_at)
+                    VALUES ({ref}.user_id, strftime('%Y-%m-%d %H:%M:%f', 'now'))
+                    ON CONFLICT(user_id) DO UPDATE SET updated_at = excluded.updated_at;
+                END
+                """)
+
+# =========================
+# Helpers
+# =========================
+MONEY_FIELDS = [
+    "sales", "gross_profit", "net_income",
+    "total_assets", "equity",
+    "current_assets", "current_liabilities",
+    "liabilities"
+]
+
+# financialsの列（user_id除く）。SELECTの列順とnamedtupleのフィールドを揃える
+FIN_COLUMNS = (
+    "id", "company_name", "industry", "year",
+    "sales", "gross_profit", "net_income",
+    "total_assets", "equity", "current_assets", "current_liabilities", "liabilities",
+    "employees",
+    "gross_profit_margin", "roe", "current_ratio", "debt_ratio", "sales_per_employee", "productivity",
+)
+# Rowのキー検索より軽い、C実装の属性アクセスでテンプレートに渡す
+FinRow = namedtuple("FinRow", FIN_COLUMNS + ("comments_json",))
+
+# 桁区切り・空白（全角含む）をC側の1パスで除去
+_MONEY_STRIP = str.maketrans("", "", ",， 　\t")
+
+def _to_float(v) -> float:
+    if v is None:
+        return 0.0
+    s = str(v).translate(_MONEY_STRIP)
+    if s == "":
+        return 0.0
+    return float(s)
+
+def _to_int(v) -> int:
+    if v is None:
+        return 0
+    s = str(v).translate(_MONEY_STRIP)
+    if s == "":
+        return 0
+    return int(float(s))  # "12.0" 対策
+
+# フォーム項目 -> 変換関数。POSTごとに項目名で分岐しないよう先に固定しておく
+_FIELD_CONV = tuple((k, _to_float) for k in MONEY_FIELDS) + (("employees", _to_int),)
+
+def parse_financial_fields(form) -> dict:
+    """フォームの数値項目を _FIELD_CONV に従って一括変換する"""
+    return {k: conv(form.get(k)) for k, conv in _FIELD_CONV}
+
+def parse_financial_form_with_unit(form) -> dict:
+    """
+    入力単位(unit)を反映して、DB保存用「円」に統一したdictを返す
+    unit: 1(円) / 1000(千円) / 1000000(百万円)
+    """
+    unit = _to_float(form.get("unit", "1"))
+    if unit not in (1.0, 1000.0, 1000000.0):
+        unit = 1.0
+
+    d = parse_financial_fields(form)
+    if unit != 1.0:
+        for k in MONEY_FIELDS:
+            d[k] *= unit  # ← unit反映（円換算）
+    return d
+
+# =========================
+# Indicator calc
+# =========================
+def calc(d):
+    return {
+        "gross_profit_margin": d["gross_profit"]/d["sales"] if d["sales"] else 0,
+        "roe": d["net_income"]/d["equity"] if d["equity"] else 0,
+        "current_ratio": d["current_assets"]/d["current_liabilities"] if d["current_liabilities"] else 0,
+        "debt_ratio": d["liabilities"]/d["total_assets"] if d["total_assets"] else 0,
+        "sales_per_employee": d["sales"]/d["employees"] if d["employees"] else 0,
+        "productivity": d["net_income"]/d["employees"] if d["employees"] else 0,
+    }
+
+def calc_batch(sales, gross_profit, net_income, total_assets, equity,
+               current_assets, current_liabilities, liabilities, employees):
+    """
+    calc() の一括版。列ごとの数値シーケンスを受け取り、
+    指標名 -> ndarray のdictを返す（0除算は calc() と同じく0）
+    """
+    import numpy as np  # 一括再計算のときしか使わないので遅延import
+
+    def div(a, b):
+        a = np.asarray(a, dtype=float)
+        b = np.asarray(b, dtype=float)
+        return np.divide(a, b, out=np.zeros_like(a), where=b != 0)
+
+    return {
+        "gross_profit_margin": div(gross_profit, sales),
+        "roe": div(net_income, equity),
+        "current_ratio": div(current_assets, current_liabilities),
+        "debt_ratio": div(liabilities, total_assets),
+        "sales_per_employee": div(sales, employees),
+        "productivity": div(net_income, employees),
+    }
+
+# =========================
+# Auth
+# =========================
+@app.route("/register", methods=["GET","POST"])
+def register():
+    if request.method == "POST":
+        u, p = request.form["username"], request.form["password"]
+        with get_conn() as con:
+            cur = con.cursor()
+            cur.execute("SELECT 1 FROM users WHERE username=?", (u,))
+            if cur.fetchone():
+                return "既に存在します"
+            with con:
+                cur.execute("INSERT INTO users VALUES(?,?)", (u, generate_password_hash(p, method=HASH_METHOD)))
+        return redirect(url_for("login"))
+    return render_template("register.html")
+
+@app.route("/login", methods=["GET","POST"])
+def login():
+    if request.method == "POST":
+        u, p = request.form["username"], request.form["password"]
+        with get_conn() as con:
+            cur = con.cursor()
+            cur.execute("SELECT * FROM users WHERE username=?", (u,))
+            user = cur.fetchone()
+        if check_password_hash(user["password"] if user else _DUMMY_HASH, p) and user:
+            session["user_id"] = u
+            _get_user_meta(u)  # オートコンプリート用データを先読み
+            return redirect(url_for("index"))
+        return "ログイン失敗"
+    return render_template("login.html")
+
+@app.route("/logout")
+def logout():
+    _user_meta.pop(session.get("user_id"), None)
+    session.clear()
+    return redirect(url_for("login"))
+
+# =========================
+# Main input
+# =========================
+@app.route("/", methods=["GET","POST"])
+def index():
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+
+    current_year = datetime.now().year
+
+    if request.method == "POST":
+        f = request.form
+
+        # 1) unitを反映して円換算
+        d = parse_financial_form_with_unit(f)
+
+        # 2) 文字項目
+        company_name = f.get("company_name", "").strip()
+        industry = f.get("industry", "").strip()
+        year = _to_int(f.get("year"))
+
+        # 3) 指標計算
+        d.update(calc(d))
+
+        with get_conn() as con:
+            # with con: でBEGIN〜COMMITをまとめ、fsyncをリクエストあたり1回に
+            with con:
+                con.execute(
+                    """
+                    INSERT INTO financials(
+                        company_name, industry, year,
+                        sales, gross_profit, net_income,
+                        total_assets, equity, current_assets, current_liabilities, liabilities,
+                        employees,
+                        gross_profit_margin, roe, current_ratio, debt_ratio, sales_per_employee, productivity,
+                        user_id
+                    )
+                    VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+                    """,
+                    (
+                        company_name, industry, year,
+                        d["sales"], d["gross_profit"], d["net_income"],
+                        d["total_assets"], d["equity"], d["current_assets"], d["current_liabilities"], d["liabilities"],
+                        d["employees"],
+                        d["gross_profit_margin"], d["roe"], d["current_ratio"], d["debt_ratio"],
+                        d["sales_per_employee"], d["productivity"],
+                        session["user_id"],
+                    )
+                )
+        return redirect(url_for("view_data"))
+
+    return render_template("index.html", current_year=current_year)
+
+# =========================
+# Industry list (JSON)
+# =========================
+# オートコンプリート用データはログイン時にまとめて読み込んでおく。
+# 鮮度はuser_meta.updated_at（トリガーが全書き込みで更新）との比較で保証する:
+# 他ワーカーの書き込みでも時刻が進むので、プロセス内dictでも陳腐化しない
+_user_meta: dict[str, dict] = {}
+
+def _get_user_meta(user_id):
+    with get_conn() as con:
+        cur = con.cursor()
+        cur.execute("SELECT updated_at FROM user_meta WHERE user_id=?", (user_id,))
+        row = cur.fetchone()
+        stamp = row["updated_at"] if row else None
+
+        meta = _user_meta.get(user_id)
+        if meta is not None and meta["stamp"] == stamp:
+            return meta
+
+        cur.execute(
+            "SELECT DISTINCT company_name FROM financials WHERE user_id=? ORDER BY company_name",
+            (user_id,)
+        )
+        companies = [r[0] for r in cur.fetchall()]
+        cur.execute(
+            "SELECT DISTINCT industry FROM financials WHERE user_id=? AND industry IS NOT NULL AND industry != ''",
+            (user_id,)
+        )
+        industries = [r[0] for r in cur.fetchall()]
+
+    meta = {"stamp": stamp, "companies": companies, "industries": industries}
+    _user_meta[user_id] = meta
+    return meta
+
+@app.route("/industry_list")
+def industry_list():
+    if "user_id" not in session:
+        return jsonify([])
+
+    return jsonify(_get_user_meta(session["user_id"])["industries"])
+
+# =========================
+# View
+# =========================
+@app.route("/view_data")
+def view_data():
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+
+    company_name = request.args.get("company_name", "").strip()
+    industry = request.args.get("industry", "").strip()
+
+    # 動的WHERE条件
+    where = ["f.user_id = ?"]
+    params = [session["user_id"]]
+
+    if company_name:
+        where.append("f.company_name LIKE ?")
+        params.append(f"%{company_name}%")
+
+    if industry:
+        where.append("f.industry LIKE ?")
+        params.append(f"%{industry}%")
+
+    # コメントはSQLite側でJSON配列にまとめて1行1企業で受け取る
+    # （LEFT JOINの行複製も、Python側でのグルーピングも不要になる）
+    sql = f"""
+        SELECT {", ".join("f." + c for c in FIN_COLUMNS)},
+               (SELECT json_group_array(
+                           json_object('id', c.id, 'content', c.content, 'created_at', c.created_at))
+                  FROM comments c
+                 WHERE c.financial_id = f.id
+                   AND c.user_id = f.user_id) AS comments_json
+        FROM financials f
+        WHERE {' AND '.join(where)}
+        ORDER BY f.company_name, f.year
+    """
+
+    with get_conn() as con:
+        cur = con.cursor()
+        cur.row_factory = None  # 素のタプルで受けてFinRowに1回で包む
+        cur.execute(sql, params)
+        financials = [FinRow(*r) for r in cur.fetchall()]
+
+    comments = {}
+    for r in financials:
+        lst = json.loads(r.comments_json)
+        if lst:
+            comments[r.id] = lst
+
+    return render_template(
+        "view_data.html",
+        financial_data=financials,
+        comments_by_id=comments,
+        company_name=company_name,
+        industry=industry
+    )
+
+# =========================
+# Edit
+# =========================
+@app.route("/edit/<int:id>", methods=["GET","POST"])
+def edit_data(id):
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+
+    with get_conn() as con:
+        cur = con.cursor()
+
+        # 本人のデータか確認
+        cur.execute("SELECT * FROM financials WHERE id=? AND user_id=?", (id, session["user_id"]))
+        data = cur.fetchone()
+        if data is None:
+            abort(404)
+
+        if request.method == "POST":
+            f = request.form
+
+            d = parse_financial_fields(f)
+
+            year = _to_int(f.get("year"))
+            company_name = f.get("company_name", "").strip()
+            industry = f.get("industry", "").strip()
+
+            d.update(calc(d))
+
+            with con:
+                con.execute(
+                    """
+                    UPDATE financials SET
+                        company_name=?, industry=?, year=?,
+                        sales=?, gross_profit=?, net_income=?,
+                        total_assets=?, equity=?, current_assets=?, current_liabilities=?, liabilities=?,
+                        employees=?,
+                        gross_profit_margin=?, roe=?, current_ratio=?, debt_ratio=?, sales_per_employee=?, productivity=?
+                    WHERE id=? AND user_id=?
+                    """,
+                    (
+                        company_name, industry, year,
+                        d["sales"], d["gross_profit"], d["net_income"],
+                        d["total_assets"], d["equity"], d["current_assets"], d["current_liabilities"], d["liabilities"],
+                        d["employees"],
+                        d["gross_profit_margin"], d["roe"], d["current_ratio"], d["debt_ratio"],
+                        d["sales_per_employee"], d["productivity"],
+                        id, session["user_id"],
+                    )
+                )
+            return redirect(url_for("edit_data", id=id))
+
+        cur.execute(
+            "SELECT * FROM comments WHERE financial_id=? AND user_id=? ORDER BY id DESC",
+            (id, session["user_id"])
+        )
+        comments = cur.fetchall()
+
+    return render_template("edit_data.html", data=data, comments=comments)
+
+# =========================
+# Recompute (bulk)
+# =========================
+@app.route("/recompute_all", methods=["POST"])
+def recompute_all():
+    """指標の計算式を変えたあとなどに、自分の全行の指標を再計算する"""
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+
+    with get_conn() as con:
+        cur = con.cursor()
+        cur.execute("""
+            SELECT id, sales, gross_profit, net_income, total_assets, equity,
+                   current_assets, current_liabilities, liabilities, employees
+            FROM financials
+            WHERE user_id=?
+        """, (session["user_id"],))
+        rows = cur.fetchall()
+
+        if rows:
+            ids, *inputs = zip(*rows)
+            m = calc_batch(*inputs)
+            params = list(zip(
+                m["gross_profit_margin"].tolist(), m["roe"].tolist(),
+                m["current_ratio"].tolist(), m["debt_ratio"].tolist(),
+                m["sales_per_employee"].tolist(), m["productivity"].tolist(),
+                ids, [session["user_id"]] * len(ids),
+            ))
+            with con:
+                con.executemany("""
+                    UPDATE financials SET
+                        gross_profit_margin=?, roe=?, current_ratio=?, debt_ratio=?,
+                        sales_per_employee=?, productivity=?
+                    WHERE id=? AND user_id=?
+                """, params)
+
+    return redirect(url_for("view_data"))
+
+# =========================
+# Comment
+# =========================
+@app.route("/add_comment/<int:id>", methods=["POST"])
+def add_comment(id):
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+
+    with get_conn() as con:
+        cur = con.cursor()
+
+        cur.execute("SELECT id FROM financials WHERE id=? AND user_id=?", (id, session["user_id"]))
+        if cur.fetchone() is None:
+            abort(404)
+
+        content = request.form.get("content", "").strip()
+        if content == "":
+            return redirect(url_for("edit_data", id=id))
+
+        with con:
+            con.execute(
+                "INSERT INTO comments(financial_id, user_id, content) VALUES(?,?,?)",
+                (id, session["user_id"], content)
+            )
+    return redirect(url_for("edit_data", id=id))
+
+@app.route("/edit_comment/<int:id>", methods=["POST"])
+def edit_comment(id):
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+
+    content = request.form.get("content", "").strip()
+
+    with get_conn() as con:
+        cur = con.cursor()
+
+        if content == "":
+            cur.execute("SELECT financial_id FROM comments WHERE id=? AND user_id=?", (id, session["user_id"]))
+            row = cur.fetchone()
+        else:
+            # 所有チェックと更新をRETURNINGで1文に（往復半減・TOCTOUなし）
+            with con:
+                cur.execute(
+                    "UPDATE comments SET content=? WHERE id=? AND user_id=? RETURNING financial_id",
+                    (content, id, session["user_id"])
+                )
+                row = cur.fetchone()
+
+        if row is None:
+            abort(404)
+
+    return redirect(url_for("edit_data", id=row["financial_id"]))
+
+@app.route("/delete_comment/<int:id>", methods=["POST"])
+def delete_comment(id):
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+
+    with get_conn() as con:
+        with con:
+            cur = con.execute(
+                "DELETE FROM comments WHERE id=? AND user_id=? RETURNING financial_id",
+                (id, session["user_id"])
+            )
+            row = cur.fetchone()
+
+    if row is None:
+        abort(404)
+
+    return redirect(url_for("edit_data", id=row["financial_id"]))
+
+# =========================
+# Excel
+# =========================
+@app.route("/download_excel")
+def download_excel():
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+
+    user = session["user_id"]
+
+    with get_conn() as con:
+        cur = con.cursor()
+
+        # 最終更新時刻からETagを作り、変更がなければ生成自体をスキップして304
+        cur.execute("SELECT updated_at FROM user_meta WHERE user_id=?", (user,))
+        meta = cur.fetchone()
+        etag = hashlib.md5(f"{user}:{meta['updated_at']}".encode()).hexdigest() if meta else None
+        if etag and etag in request.if_none_match:
+            return "", 304, {"ETag": etag}
+
+        cur.row_factory = None  # 出力列を明示しているのでタプルのまま流す
+        cur.execute(f"""
+            SELECT {", ".join("f." + c for c in FIN_COLUMNS[1:])},
+                   GROUP_CONCAT(comments.content, ' / ') AS comments
+            FROM financials AS f
+            LEFT JOIN comments
+                   ON f.id = comments.financial_id
+                  AND comments.user_id = ?
+            WHERE f.user_id = ?
+            GROUP BY f.id
+            ORDER BY f.company_name, f.year
+        """, (user, user))
+
+        # DataFrameに積まず、カーソルからそのままxlsxへ流し込む（メモリO(1)）
+        out = io.BytesIO()
+        wb = xlsxwriter.Workbook(out, {"constant_memory": True, "in_memory": True})
+        ws = wb.add_worksheet()
+
+        ws.write_row(0, 0, FIN_COLUMNS[1:] + ("comments",))
+        for i, r in enumerate(cur, 1):
+            ws.write_row(i, 0, r)
+        wb.close()
+
+    out.seek(0)
+
+    # SEND_FILE_MAX_AGE_DEFAULT（/static向けの30日）を引き継がないようmax_age=0で
+    # 毎回ETag再検証させる（ユーザー固有データを共有キャッシュに置かせない）
+    resp = send_file(out, download_name="financial_data.xlsx", as_attachment=True,
+                     conditional=True, max_age=0)
+    if meta:
+        resp.set_etag(etag)
+        resp.last_modified = datetime.strptime(meta["updated_at"], "%Y-%m-%d %H:%M:%S.%f")
+    return resp
+
+# =========================
+# Graph
+# =========================
+@app.route("/graph_view")
+def graph_view():
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+
+    with get_conn() as con:
+        cur = con.cursor()
+
+        cur.execute("""
+            SELECT company_name, year, sales, roe, productivity
+            FROM financials
+            WHERE user_id=?
+            ORDER BY company_name, year
+        """, (session["user_id"],))
+
+        # 列ごとの配列（SoA）で渡す: キー名の繰り返しがなくJSONが小さい
+        keys = ("company_name", "year", "sales", "roe", "productivity")
+        cols = list(zip(*cur.fetchall()))
+        rows = dict(zip(keys, (list(c) for c in cols))) if cols else {k: [] for k in keys}
+
+    return render_template("graph.html", rows=rows)
+
+@app.route("/get_companies")
+def get_companies():
+    if "user_id" not in session:
+        return jsonify([])
+
+    q = request.args.get("query", "").strip().lower()
+
+    companies = _get_user_meta(session["user_id"])["companies"]
+    if q:
+        companies = [c for c in companies if q in c.lower()]
+    return jsonify(companies[:10])
+
+
+# =========================
+# Run
+# =========================
+if __name__ == "__main__":
+    init_db()
+    app.run(debug=True)
@@ -0,0 +1,11 @@
+"""gunicorn用エントリポイント
+
+起動例:
+    gunicorn -k gevent -w 2 --worker-connections 500 wsgi:app
+"""
+from gevent import monkey
+monkey.patch_all()
+
+from finance_app import app, init_db
+
+init_db()